@@ -17,8 +17,6 @@ setup(
         'drain3',
         'sklearn', 
         'pyod',
-        'torch',
-        'tqdm',
-        'tqdm-logging-wrapper'
+        'torch'
     ]
 )
@@ -15,7 +15,7 @@ import pandas as pd
 import ml4logs
 from ml4logs.data.hdfs import load_labels
 from ml4logs.features.count_features import CountFeatureExtractor
-from ml4logs.features.utils import load_features_as_dict
+from ml4logs.features.utils import load_features, group_features
 
 # ===== GLOBALS =====
 logger = logging.getLogger(__name__)
@@ -38,7 +38,10 @@ def aggregate_by_blocks(args):
     ml4logs.utils.mkdirs(files=[dataset_path])
 
     logger.info(f'Loading features grouped by blocks,\n labels_path: {labels_path}, features_path: {features_path}')
-    groups = load_features_as_dict(labels_path, features_path)
+    # features and labels are loaded once, the groups are views into the features
+    features = load_features(features_path)
+    labels = load_labels(labels_path)
+    groups = group_features(features, labels)
     logger.info(f"Loaded {len(groups)} groups")
     
     if "load_transform_path" in args: # read a once fitted transform, e.g., on training data
@@ -58,17 +61,18 @@ def aggregate_by_blocks(args):
                 joblib.dump(fe, save_transform_path)
         else:
             METHODS = {
-                "max": lambda block: block.max(axis=0)
+                "max": np.maximum
             }
             method = METHODS[args["method"]]
-            first = list(groups.keys())[0]
-            X = np.empty((len(groups), groups[first].shape[1]), dtype=np.float32)
-            for i, (block_id, block) in enumerate(groups.items()):
-                assert block.shape[0] > 0, f"Zero size block for {block_id}!"
-                X[i, :] = method(block)
+            # blocks are contiguous slices of the features (in the order of labels),
+            # so all of them are reduced at once instead of one block at a time
+            sizes = labels.BlockSize.values
+            assert np.all(sizes > 0), f"Zero size block for {labels.BlockId[sizes == 0].tolist()}!"
+            offsets = labels.BlockOffset.values
+            assert np.array_equal(offsets[1:], offsets[:-1] + sizes[:-1]), "Blocks are not contiguous!"
+            X = method.reduceat(features[:offsets[-1] + sizes[-1]], offsets, axis=0)
+            X = X.astype(np.float32, copy=False)
 
-    logger.info('Loading labels')
-    labels = load_labels(labels_path)
     _check_groups_and_labels(groups, labels.BlockId)
     Y = labels.Label.values
 
@@ -22,6 +22,8 @@ from ml4logs.data.hdfs import load_data_as_dict
 
 # ===== GLOBALS =====
 logger = logging.getLogger(__name__)
+# HDFS lines start with a timestamp, e.g. "081109 203518", compiled once for all blocks
+DATETIME_FROM_LINE = re.compile(r'(^\d{6} \d{6})', re.ASCII)
 
 
 # ===== FUNCTIONS =====
@@ -82,11 +84,9 @@ def calculate_timedeltas_from_timestamps(timestamps: np.array) -> np.array:
 
 
 def get_timedeltas(block_of_logs: List) -> np.array:
-    datetime_from_line = re.compile(r'(^\d{6} \d{6})')
-
     timestamps = np.empty(shape=(len(block_of_logs),), dtype=np.object)
     for i, log in enumerate(block_of_logs):
-        str_timestamp = search(datetime_from_line, log)
+        str_timestamp = search(DATETIME_FROM_LINE, log)
         timestamps[i] = get_datetime(str_timestamp)
 
     timedeltas = calculate_timedeltas_from_timestamps(timestamps)
@@ -1,6 +1,8 @@
 # ===== IMPORTS =====
 # === Standard library ===
+import itertools as itools
 import logging
+import multiprocessing
 import pathlib
 
 # === Thirdparty ===
@@ -13,6 +15,9 @@ import ml4logs
 
 # ===== GLOBALS =====
 logger = logging.getLogger(__name__)
+# fastText model loaded by preprocess_fasttext() before forking the workers,
+# so that they share it instead of loading their own copies
+_model = None
 
 
 # ===== FUNCTIONS =====
@@ -29,24 +34,86 @@ def train_fasttext(args):
 
 
 def preprocess_fasttext(args):
+    global _model
     logs_path = pathlib.Path(args['logs_path'])
     model_path = pathlib.Path(args['model_path'])
     embeddings_path = pathlib.Path(args['embeddings_path'])
+    n_workers = args.get('n_workers', 1)
 
     ml4logs.utils.mkdirs(files=[embeddings_path])
 
     logger.info('Loading fastText model from \'%s\'', model_path)
-    model = fasttext.load_model(str(model_path))
-    n_lines = ml4logs.utils.count_file_lines(logs_path)
-    step = n_lines // 10
-    logger.info('Starting preprocessing using fastText')
-    embeddings = []
-    with logs_path.open() as logs_in_f:
-        for i, line in enumerate(logs_in_f):
-            embedding = model.get_sentence_vector(line.strip())
-            embeddings.append(embedding)
-            if i % step <= 0:
-                logger.info('Processed %d / %d lines', i, n_lines)
-    embeddings = np.stack(embeddings)
-    logger.info('Saving embeddings into \'%s\'', embeddings_path)
-    np.save(embeddings_path, embeddings)
+    _model = fasttext.load_model(str(model_path))
+    # lines are embedded independently, so the file is split into contiguous
+    # shards (given by byte offsets) and each worker fills its own rows of the output
+    shards = _split_file(logs_path, n_workers)
+    pool = None
+    starmap = itools.starmap
+    if n_workers > 1:
+        logger.info('Forking %d worker processes', n_workers)
+        pool = multiprocessing.get_context('fork').Pool(n_workers)
+        starmap = pool.starmap
+    try:
+        logger.info('Count lines in \'%s\'', logs_path)
+        counts = list(starmap(_count_lines, [
+            (logs_path, start, stop) for start, stop in shards]))
+        n_lines = sum(counts)
+        # embeddings are written straight into a preallocated .npy file instead of
+        # being collected in a list of arrays and stacked at the end
+        logger.info('Creating embeddings file \'%s\'', embeddings_path)
+        embeddings = np.lib.format.open_memmap(
+            embeddings_path, mode='w+', dtype=np.float32,
+            shape=(n_lines, _model.get_dimension()))
+        rows = np.cumsum([0] + counts[:-1]).tolist()
+        logger.info('Starting preprocessing using fastText')
+        list(starmap(_embed_shard, [
+            (logs_path, embeddings_path, start, stop, row, count, n_lines)
+            for (start, stop), row, count in zip(shards, rows, counts)]))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _model = None
+    logger.info('Flushing embeddings into \'%s\'', embeddings_path)
+    embeddings.flush()
+
+
+def _split_file(path, n_shards):
+    # byte offsets of line starts splitting the file into roughly equal shards
+    size = path.stat().st_size
+    bounds = [0]
+    with path.open('rb') as in_f:
+        for k in range(1, n_shards):
+            in_f.seek(k * size // n_shards)
+            in_f.readline()
+            bounds.append(max(in_f.tell(), bounds[-1]))
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _read_lines(path, start, stop):
+    with path.open('rb') as in_f:
+        in_f.seek(start)
+        pos = start
+        while pos < stop:
+            line = in_f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+def _count_lines(path, start, stop):
+    return sum(1 for _ in _read_lines(path, start, stop))
+
+
+def _embed_shard(logs_path, embeddings_path, start, stop, row, count, n_lines):
+    embeddings = np.load(embeddings_path, mmap_mode='r+')
+    step = max(count // 10, 1)
+    lines = _read_lines(logs_path, start, stop)
+    for i, line in enumerate(lines):
+        embeddings[row + i] = _model.get_sentence_vector(line.decode('utf8').strip())
+        if i % step <= 0:
+            # progress of all shards is interleaved, so the global row is logged
+            logger.info('Processed line %d / %d', row + i, n_lines)
+    embeddings.flush()
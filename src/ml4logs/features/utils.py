@@ -26,10 +26,17 @@ def load_features(features_path: str) -> np.ndarray:
     return data
 
     
-def load_features_as_dict(labels_path: str, features_path: str) -> typing.OrderedDict:
+def load_features_as_dict(labels_path: str, features_path: str, dtype=None) -> typing.OrderedDict:
     features = load_features(features_path) # the order of features is same as the order of data
+    if dtype is not None:
+        # convert all features at once, the blocks are views into this array
+        features = features.astype(dtype, copy=False)
     labels = load_labels(labels_path)
+    return group_features(features, labels)
 
+
+def group_features(features: np.ndarray, labels: pd.DataFrame) -> typing.OrderedDict:
+    # the blocks are views into features, given by the offsets and sizes in labels
     groups = OrderedDict()
     for row in labels.itertuples():
         off = row.BlockOffset
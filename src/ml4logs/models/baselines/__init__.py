@@ -1,3 +1,3 @@
-from ml4logs.models.baselines.core import SequenceDataset, SeqModel
+from ml4logs.models.baselines.core import SequenceDataset, SeqModel, BucketBatchSampler, create_dataloader, compile_model, create_grad_scaler
 from ml4logs.models.baselines.seq2label import train_test_seq2label
 from ml4logs.models.baselines.seq2seq import train_test_seq2seq
@@ -1,6 +1,9 @@
 # ===== IMPORTS =====
 # === Standard library ===
+import logging
+
 # === Thirdparty ===
+import numpy as np
 import torch
 import torch.utils.data as tdata
 import torch.nn.utils.rnn as tutilsrnn
@@ -8,6 +11,10 @@ import torch.nn.utils.rnn as tutilsrnn
 # === Local ===
 
 
+# ===== GLOBALS =====
+logger = logging.getLogger(__name__)
+
+
 # ===== CLASSES =====
 class SequenceDataset(tdata.Dataset):
     def __init__(self, *args):
@@ -20,6 +27,32 @@ class SequenceDataset(tdata.Dataset):
         return len(self._data)
 
 
+class BucketBatchSampler(tdata.Sampler):
+    # yields batches of indices of sequences with similar lengths, so that padding
+    # to the longest sequence in a batch wastes as little compute as possible
+    def __init__(self, lengths, batch_size, shuffle=True):
+        self._lengths = np.asarray(lengths)
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+
+    def __iter__(self):
+        if self._shuffle:
+            # random tie-breaking varies the batches of equally long sequences between epochs
+            ties = np.random.permutation(len(self._lengths))
+            order = np.lexsort((ties, self._lengths))
+        else:
+            order = np.argsort(self._lengths, kind='stable')
+        batches = [order[i:i + self._batch_size]
+                   for i in range(0, len(order), self._batch_size)]
+        if self._shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return (len(self._lengths) + self._batch_size - 1) // self._batch_size
+
+
 class SeqModel(torch.nn.Module):
     def __init__(self, f_dim, n_lstm_layers=1,
                  n_hidden_linears=2, linear_width=300, linear_norm=False,
@@ -41,5 +74,53 @@ class SeqModel(torch.nn.Module):
 
     def forward(self, X):
         out, _ = self._lstm(X)
-        out, lengths = tutilsrnn.pad_packed_sequence(X, batch_first=True)
-        return self._linears(out)
+        # the linears run over the packed (real) time steps only, padded
+        # positions are filled with zeros afterwards
+        out = tutilsrnn.PackedSequence(self._linears(out.data), out.batch_sizes,
+                                       out.sorted_indices, out.unsorted_indices)
+        out, lengths = tutilsrnn.pad_packed_sequence(out, batch_first=True)
+        return out
+
+    def forward_last(self, X):
+        # many-to-one variant of forward(), only the last time step of every
+        # sequence goes through the linears, shape (batch_size, linear_out_dim)
+        out, _ = self._lstm(X)
+        batch_sizes = out.batch_sizes
+        # lengths and start offsets of time steps in the packed (sorted) order
+        lengths = (batch_sizes.unsqueeze(0)
+                   > torch.arange(batch_sizes[0]).unsqueeze(1)).sum(dim=1)
+        starts = torch.cumsum(batch_sizes, dim=0) - batch_sizes
+        last = (starts[lengths - 1] + torch.arange(len(lengths))).to(out.data.device)
+        if out.unsorted_indices is not None:
+            last = last[out.unsorted_indices]
+        return self._linears(out.data[last])
+
+
+# ===== FUNCTIONS =====
+def create_dataloader(dataset, batch_size, collate_fn, bucket_by_length=False,
+                      **kwargs):
+    if bucket_by_length:
+        lengths = [len(sample[0]) for sample in dataset]
+        sampler = BucketBatchSampler(lengths, batch_size)
+        return tdata.DataLoader(dataset, batch_sampler=sampler,
+                                collate_fn=collate_fn, **kwargs)
+    return tdata.DataLoader(dataset, batch_size=batch_size,
+                            collate_fn=collate_fn, shuffle=True, **kwargs)
+
+
+def compile_model(model):
+    # only the linear head is compiled, the LSTM over packed sequences already
+    # runs as a single cuDNN kernel and would just cause graph breaks
+    if not hasattr(torch, 'compile'):
+        logger.warning('torch.compile is not available (torch < 2.0), '
+                       'running the model eagerly')
+        return model
+    model._linears = torch.compile(model._linears, dynamic=True)
+    return model
+
+
+def create_grad_scaler(enabled):
+    # torch.amp.GradScaler replaces torch.cuda.amp.GradScaler, deprecated since torch 2.3
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
@@ -1,6 +1,7 @@
 # ===== IMPORTS =====
 # === Standard library ===
 from collections import defaultdict, Counter
+import contextlib
 import logging
 import pathlib
 from pathlib import Path
@@ -11,7 +12,6 @@ import numpy as np
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
 import torch
-import torch.utils.data as tdata
 import torch.nn.functional as tfunctional
 import torch.nn.utils.rnn as tutilsrnn
 from sklearn.metrics import precision_recall_fscore_support
@@ -31,10 +31,13 @@ ABNORMAL_LABEL = 1
 # ===== CLASSES =====
 class Seq2LabelModelTrainer:
     def __init__(self, device, f_dim, many_to_one, model_kwargs,
-                 optim_kwargs, lr_scheduler_kwargs):
+                 optim_kwargs, lr_scheduler_kwargs, amp=False,
+                 compile_=False):
         self._model = ml4logs.models.baselines.SeqModel(
             f_dim, **model_kwargs
         ).to(device)
+        if compile_:
+            ml4logs.models.baselines.compile_model(self._model)
         self._criterion = torch.nn.BCEWithLogitsLoss()
         self._optimizer = torch.optim.Adam(
             self._model.parameters(), **optim_kwargs)
@@ -42,17 +45,22 @@ class Seq2LabelModelTrainer:
             self._optimizer, **lr_scheduler_kwargs)
         self._device = device
         self._many_to_one = many_to_one
+        # mixed precision training and inference, only on CUDA
+        self._amp = amp and device.type == 'cuda'
+        self._scaler = ml4logs.models.baselines.create_grad_scaler(self._amp)
 
     def train(self, dataloader):
         self._model.train()
         train_loss = 0.0
         for inputs, labels, lengths in dataloader:
-            results, labels, _ = self._forward(inputs, labels, lengths)
-            loss = self._criterion(results, labels)
+            with self._autocast():
+                results, labels, _ = self._forward(inputs, labels, lengths)
+                loss = self._criterion(results, labels)
             train_loss += loss.item()
-            self._optimizer.zero_grad()
-            loss.backward()
-            self._optimizer.step()
+            self._optimizer.zero_grad(set_to_none=True)
+            self._scaler.scale(loss).backward()
+            self._scaler.step(self._optimizer)
+            self._scaler.update()
         self._scheduler.step()
         return train_loss / len(dataloader)
 
@@ -61,11 +69,14 @@ class Seq2LabelModelTrainer:
         self._model.eval()
         Ys = []
         Ts = []
-        with torch.no_grad():
+        with torch.inference_mode(), self._autocast():
             for X, T, L in dataloader:
-                Y, T, _ = self._forward(X, T, L)
-                Ys.append(Y.data.to(device='cpu').numpy().reshape(-1))
-                Ts.append(T.data.to(device='cpu').numpy().reshape(-1))
+                Y, _, _ = self._forward(X, T, L)
+                # targets are taken from the batch on CPU rather than copied back from the device
+                if not self._many_to_one:
+                    T, _ = tutilsrnn.pad_packed_sequence(T, batch_first=True)
+                Ys.append(Y.data.float().to(device='cpu').numpy().reshape(-1))
+                Ts.append(T.numpy().reshape(-1))
         Ys = np.concatenate(Ys)
         Ts = np.concatenate(Ts)
         # logger.info(f"{Ys.shape}, {Ts.shape}")
@@ -74,7 +85,7 @@ class Seq2LabelModelTrainer:
     def evaluate(self, dataloader):
         self._model.eval()
         total_loss = 0.0
-        with torch.no_grad():
+        with torch.inference_mode(), self._autocast():
             for inputs, labels, lengths in dataloader:
                 results, labels, _ = self._forward(inputs, labels, lengths)
                 loss = self._criterion(results, labels)
@@ -94,6 +105,12 @@ class Seq2LabelModelTrainer:
     #     metrics.update(get_threshold_metrics(T, Y))
     #     return metrics
 
+    def _autocast(self):
+        if not self._amp:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self._device.type,
+                              dtype=torch.float16)
+
     def _forward(self, X, T, L):
         if self._many_to_one:
             return self._forward_many_to_one(X, T, L)
@@ -103,20 +120,21 @@ class Seq2LabelModelTrainer:
 
     def _forward_many_to_one(self, X, T, L):
         # gets data as created by `pad_collate()`
-        X = X.to(self._device)
-        T = T.to(self._device)
+        # batches come from pinned memory, the copies do not block the host
+        X = X.to(self._device, non_blocking=True)
+        T = T.to(self._device, non_blocking=True)
 
-        # self._model output has shape: (batch_size, max_sequence_length, 1) - there is a single output neuron
-        Y = self._model(X)
-        Y = Y.reshape(Y.shape[0], Y.shape[1]) # reshape to (batch_size, max_sequence_length)
-        Y = Y[range(Y.shape[0]), L - 1] # L - 1: indices of last elements of each output sequence
+        # only the last elements of each sequence are predicted,
+        # the output has shape: (batch_size, 1) - there is a single output neuron
+        Y = self._model.forward_last(X)
+        Y = Y.reshape(Y.shape[0]) # reshape to (batch_size, )
 
         return Y, T, L
 
     def _forward_many_to_many(self, X, T):
         # gets data as created by `pad_collate()`
-        X = X.to(self._device)
-        T = T.to(self._device)
+        X = X.to(self._device, non_blocking=True)
+        T = T.to(self._device, non_blocking=True)
 
         # T (labels) shape will be (batch_size, max_sequence_length)
         # lengths will be (batch_size, ) tensor with actual sequence lengths
@@ -125,22 +143,9 @@ class Seq2LabelModelTrainer:
             batch_first=True)
 
         # results will be (batch_size, max_sequence_length, 1) - there is a single output neuron
-        Y = self._model(X)
-
-        # the network predicts even after actual sequence_length
-        # the following pack_padded and pad_packed will set all these predictions to 0
+        # the network only predicts for actual sequence_length, predictions for padding are 0
         # so they do not mess with loss (targets are also padded b zeros)
-        Y = tutilsrnn.pack_padded_sequence(
-            Y,
-            lengths,
-            batch_first=True,
-            enforce_sorted=False
-        )
-
-        Y, _ = tutilsrnn.pad_packed_sequence(
-            Y,
-            batch_first=True
-        )
+        Y = self._model(X)
 
         # squeeze removes the last dimension so we get (batch_size, max_sequence_length)
         return torch.squeeze(Y), T, lengths
@@ -166,7 +171,7 @@ def train_test_seq2label(args):
         logger.info(
             f'Loading split:\n\t"{args[input_path]}"\n\t"{args[label_path]}"')
         labels = load_labels(args[label_path])
-        inputs = load_features_as_dict(args[label_path], args[input_path])
+        inputs = load_features_as_dict(args[label_path], args[input_path], dtype=np.float32)
         logger.info(
             f" # input blocks: {len(inputs)}, # labels: {len(labels)}")
         return inputs, labels
@@ -190,12 +195,19 @@ def train_test_seq2label(args):
     loaders_kwargs = {
         'batch_size': args['batch_size'],
         'collate_fn': pad_collate_many_to_one if args.get("many_to_one", True) else pad_collate_many_to_many,
-        'shuffle': True,
+        'bucket_by_length': args.get('bucket_by_length', False),
+        # collating (packing) batches runs in worker processes
+        'num_workers': args.get('num_workers', 0),
         'pin_memory': True
     }
-    train_l = tdata.DataLoader(train_dataset, **loaders_kwargs)
-    validation_l = tdata.DataLoader(validation_dataset, **loaders_kwargs)
-    test_l = tdata.DataLoader(test_dataset, **loaders_kwargs)
+    create_dataloader = ml4logs.models.baselines.create_dataloader
+    # only the train loader keeps its workers alive across epochs, the other
+    # loaders fork theirs per pass, so at most 2 * num_workers workers are alive
+    train_l = create_dataloader(
+        train_dataset, persistent_workers=args.get('num_workers', 0) > 0,
+        **loaders_kwargs)
+    validation_l = create_dataloader(validation_dataset, **loaders_kwargs)
+    test_l = create_dataloader(test_dataset, **loaders_kwargs)
 
     logger.info('Creating model, optimizer, lr_scheduler and trainer')
     device = torch.device(args['device'])
@@ -207,6 +219,8 @@ def train_test_seq2label(args):
         args['model_kwargs'],
         args['optim_kwargs'],
         args['lr_scheduler_kwargs'],
+        amp=args.get('amp', False),
+        compile_=args.get('compile', False)
     )
 
     method_label = "lstm_classifier_m2o" if many_to_one else "lstm_classifier_m2m"
@@ -249,6 +263,12 @@ def train_test_seq2label(args):
 
     stats['metrics'][method_label] = metrics
 
+    # free the model, the loader workers and the cached GPU memory
+    # before the following pipeline steps
+    del trainer, train_l, validation_l, test_l
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+
     logger.info('Saving metrics into \'%s\'', stats_path)
     stats_path.write_text(json.dumps(stats, indent=4))
 
@@ -285,7 +305,7 @@ def pad_collate_many_to_one(samples):
     # pack inputs
     inputs = tutilsrnn.pack_sequence(inputs, enforce_sorted=False)
 
-    return inputs, torch.FloatTensor(labels), lengths
+    return inputs, torch.stack(labels), lengths
 
 def pad_collate_many_to_many(samples):
     # samples: list of (input,lable) tuples:
@@ -1,5 +1,6 @@
 # ===== IMPORTS =====
 # === Standard library ===
+import contextlib
 import logging
 import pathlib
 import json
@@ -16,6 +17,7 @@ from sklearn.metrics import precision_recall_fscore_support
 
 # === Local ===
 import ml4logs
+from ml4logs.models.baselines.core import SeqModel
 
 
 # ===== GLOBALS =====
@@ -38,34 +40,19 @@ class SequenceDataset(tdata.Dataset):
         return len(self._inputs)
 
 
-class Seq2SeqModel(torch.nn.Module):
-    def __init__(self, f_dim, n_lstm_layers=1,
-                 n_hidden_linears=2, linear_width=300, linear_norm=False):
-        super().__init__()
-        self._lstm = torch.nn.LSTM(f_dim, f_dim, batch_first=True,
-                                   num_layers=n_lstm_layers)
-        linears = [torch.nn.Linear(f_dim, linear_width)]
-        if linear_norm:
-            linears.append(torch.nn.LayerNorm(linear_width))
-        linears.append(torch.nn.LeakyReLU())
-        for _ in range(n_hidden_linears):
-            linears.append(torch.nn.Linear(linear_width, linear_width))
-            if linear_norm:
-                linears.append(torch.nn.LayerNorm(linear_width))
-            linears.append(torch.nn.LeakyReLU())
-        linears.append(torch.nn.Linear(linear_width, f_dim))
-        self._linears = torch.nn.Sequential(*linears)
-
-    def forward(self, X):
-        out, _ = self._lstm(X)
-        out, lengths = tutilsrnn.pad_packed_sequence(X, batch_first=True)
-        return self._linears(out)
+class Seq2SeqModel(SeqModel):
+    # predicts the following log line embedding, so the output has the input dimension
+    def __init__(self, f_dim, **kwargs):
+        super().__init__(f_dim, linear_out_dim=f_dim, **kwargs)
 
 
 class Seq2SeqModelTrainer:
     def __init__(self, device, f_dim, model_kwargs,
-                 optim_kwargs, lr_scheduler_kwargs):
+                 optim_kwargs, lr_scheduler_kwargs, amp=False,
+                 compile_=False):
         self._model = Seq2SeqModel(f_dim, **model_kwargs).to(device)
+        if compile_:
+            ml4logs.models.baselines.compile_model(self._model)
         self._criterion = torch.nn.MSELoss()
         self._optimizer = torch.optim.Adam(
             self._model.parameters(), **optim_kwargs)
@@ -73,24 +60,29 @@ class Seq2SeqModelTrainer:
             self._optimizer, **lr_scheduler_kwargs)
         self._device = device
         self._threshold = 0.0
+        # mixed precision training and inference, only on CUDA
+        self._amp = amp and device.type == 'cuda'
+        self._scaler = ml4logs.models.baselines.create_grad_scaler(self._amp)
 
     def train(self, dataloader):
         self._model.train()
         train_loss = 0.0
         for inputs, outputs, _ in dataloader:
-            results, outputs = self._forward(inputs, outputs)
-            loss = self._criterion(results, outputs)
+            with self._autocast():
+                results, outputs = self._forward(inputs, outputs)
+                loss = self._criterion(results, outputs)
             train_loss += loss.item()
-            self._optimizer.zero_grad()
-            loss.backward()
-            self._optimizer.step()
+            self._optimizer.zero_grad(set_to_none=True)
+            self._scaler.scale(loss).backward()
+            self._scaler.step(self._optimizer)
+            self._scaler.update()
         self._scheduler.step()
         return train_loss / len(dataloader)
 
     def evaluate(self, dataloader):
         self._model.eval()
         total_loss = 0.0
-        with torch.no_grad():
+        with torch.inference_mode(), self._autocast():
             for inputs, outputs, _ in dataloader:
                 results, outputs = self._forward(inputs, outputs)
                 loss = self._criterion(results, outputs)
@@ -100,12 +92,14 @@ class Seq2SeqModelTrainer:
     def compute_threshold(self, dataloader):
         self._model.eval()
         errors = []
-        for inputs, outputs, _ in dataloader:
-            results, outputs = self._forward(inputs, outputs)
-            loss = tfunctional.mse_loss(results, outputs, reduction='none')
-            loss = torch.mean(loss, dim=2)
-            loss = torch.mean(loss, dim=1)
-            errors.extend(loss.tolist())
+        with torch.inference_mode(), self._autocast():
+            for inputs, outputs, _ in dataloader:
+                results, outputs = self._forward(inputs, outputs)
+                loss = tfunctional.mse_loss(results, outputs, reduction='none')
+                loss = torch.mean(loss, dim=2)
+                loss = torch.mean(loss, dim=1)
+                errors.append(loss.float())
+        errors = torch.cat(errors).to(device='cpu').numpy()
         self._threshold = np.mean(errors) + 2 * np.std(errors)
         return self._threshold
 
@@ -115,7 +109,7 @@ class Seq2SeqModelTrainer:
         self._model.eval()
         labels = []
         result_labels = []
-        with torch.no_grad():
+        with torch.inference_mode(), self._autocast():
             for inputs, outputs, labels_ in dataloader:
                 results, outputs = self._forward(inputs, outputs)
                 loss = tfunctional.mse_loss(results, outputs, reduction='none')
@@ -140,25 +134,23 @@ class Seq2SeqModelTrainer:
     def threshold(self):
         return self._threshold
 
+    def _autocast(self):
+        if not self._amp:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self._device.type,
+                              dtype=torch.float16)
+
     def _forward(self, inputs, outputs):
-        inputs = inputs.to(self._device)
-        outputs = outputs.to(self._device)
+        # batches come from pinned memory, the copies do not block the host
+        inputs = inputs.to(self._device, non_blocking=True)
+        outputs = outputs.to(self._device, non_blocking=True)
         outputs, lengths = tutilsrnn.pad_packed_sequence(
             outputs,
             batch_first=True
         )
 
+        # predictions after actual sequence lengths are already zeros
         results = self._model(inputs)
-        results = tutilsrnn.pack_padded_sequence(
-            results,
-            lengths,
-            batch_first=True,
-            enforce_sorted=False
-        )
-        results, _ = tutilsrnn.pad_packed_sequence(
-            results,
-            batch_first=True
-        )
 
         return results, outputs
 
@@ -216,11 +208,12 @@ def train_test_seq2seq(args):
     features_scaled = scaler.transform(features)
 
     logger.info('Create sequence datasets')
-    values = {}
-    for block, array in zip(blocks, features_scaled):
-        list_ = values.setdefault(block, list())
-        list_.append(array)
-    values = {block: np.stack(arrays) for block, arrays in values.items()}
+    # group lines by blocks with a single stable sort, the per-block arrays
+    # are views into one preallocated array instead of stacked row lists
+    order = np.argsort(blocks, kind='stable')
+    blocks_sorted, block_starts = np.unique(blocks[order], return_index=True)
+    values = dict(zip(blocks_sorted,
+                      np.split(features_scaled[order], block_starts[1:])))
     train_dataset = create_sequence_dataset(values, labels, train_blocks)
     validation_dataset = create_sequence_dataset(
         values, labels, validation_blocks)
@@ -230,12 +223,19 @@ def train_test_seq2seq(args):
     loaders_kwargs = {
         'batch_size': args['batch_size'],
         'collate_fn': pad_collate,
-        'shuffle': True,
+        'bucket_by_length': args.get('bucket_by_length', False),
+        # collating (packing) batches runs in worker processes
+        'num_workers': args.get('num_workers', 0),
         'pin_memory': True
     }
-    train_l = tdata.DataLoader(train_dataset, **loaders_kwargs)
-    validation_l = tdata.DataLoader(validation_dataset, **loaders_kwargs)
-    test_l = tdata.DataLoader(test_dataset, **loaders_kwargs)
+    create_dataloader = ml4logs.models.baselines.create_dataloader
+    # only the train loader keeps its workers alive across epochs, the other
+    # loaders fork theirs per pass, so at most 2 * num_workers workers are alive
+    train_l = create_dataloader(
+        train_dataset, persistent_workers=args.get('num_workers', 0) > 0,
+        **loaders_kwargs)
+    validation_l = create_dataloader(validation_dataset, **loaders_kwargs)
+    test_l = create_dataloader(test_dataset, **loaders_kwargs)
 
     logger.info('Create model, optimizer, lr_scheduler and trainer')
 
@@ -246,7 +246,9 @@ def train_test_seq2seq(args):
         f_dim,
         args['model_kwargs'],
         args['optim_kwargs'],
-        args['lr_scheduler_kwargs']
+        args['lr_scheduler_kwargs'],
+        amp=args.get('amp', False),
+        compile_=args.get('compile', False)
     )
 
     stats = {
@@ -283,6 +285,12 @@ def train_test_seq2seq(args):
             'F1-score = {f1:.2f}',
         ]).format(**info))
 
+    # free the model, the loader workers and the cached GPU memory
+    # before the following pipeline steps
+    del trainer, train_l, validation_l, test_l
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+
     logger.info('Save metrics into \'%s\'', stats_path)
     stats_path.write_text(json.dumps(stats, indent=4))
 
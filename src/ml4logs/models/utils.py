@@ -10,8 +10,6 @@ from typing import Dict, Union, Generator
 import numpy as np
 import pandas as pd
 from sklearn.metrics import average_precision_score, matthews_corrcoef, precision_recall_fscore_support, roc_auc_score
-from tqdm import tqdm
-import tqdm_logging_wrapper
 
 # === Local ===
 import ml4logs
@@ -93,21 +91,24 @@ def f1_score_binary(T: np.array, Y: np.array) -> np.float32:
 
 
 def find_optimal_threshold(T: np.array, Y: np.array) -> tuple:
-    # from https://github.com/LogAnalysisTeam/methods4logfiles/blob/main/src/models/utils.py
+    # based on https://github.com/LogAnalysisTeam/methods4logfiles/blob/main/src/models/utils.py
     # T - target classifications (0/1)
     # Y - predicted scores
+    # instead of classifying the whole dataset for every candidate threshold (quadratic),
+    # tp and fp counts for all thresholds are read off the sorted scores at once
 
-    ret = {}
-    # logger.info(f"Y {type(Y)} {Y.shape} = {Y}")
-    # logger.info(f"T {type(T)} {T.shape} = {T}")
-    thresholds = set(Y[T == 1])
+    Y_positive = np.sort(Y[T == 1])
+    assert len(Y_positive) > 0, "All targets are 0!"
+    thresholds = np.unique(Y_positive)
     logger.debug(f"# thresholds to test: {len(thresholds)}, T.shape = {T.shape}, Y.shape = {Y.shape}")
-    thresholds_iter = tqdm(thresholds)
-    with tqdm_logging_wrapper.wrap_logging_for_tqdm(thresholds_iter), thresholds_iter:
-        for th in thresholds_iter:
-            Ycls = classify(Y, th)
-
-            # f1 = get_metrics(T, Ycls)[metric] # slow!
-            f1 = f1_score_binary(T, Ycls) # custom implementation needed
-            ret[th] = f1
-    return max(ret.items(), key=lambda x: x[1])
\ No newline at end of file
+
+    # number of scores >= threshold, i.e., tp + fp and tp respectively
+    tp_fp = len(Y) - np.searchsorted(np.sort(Y), thresholds, side='left')
+    tp = len(Y_positive) - np.searchsorted(Y_positive, thresholds, side='left')
+    precision = tp / tp_fp
+    recall = tp / len(Y_positive)
+    # same formula as f1_score_binary()
+    f1 = (precision * recall) / (precision + recall)
+
+    best = np.argmax(f1)
+    return thresholds[best], f1[best]